@@ -3,7 +3,7 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 from caffe2.python import core, workspace
-from hypothesis import given
+from hypothesis import given, settings
 import caffe2.python.hypothesis_test_util as hu
 import hypothesis.strategies as st
 import numpy as np
@@ -11,6 +11,84 @@ import numpy as np
 import unittest
 
 
+_CACHED_OPS = {}
+
+
+def _cached_op(op_type, inputs, outputs, **kwargs):
+    # The operator args only depend on a handful of sampled parameters, so
+    # build each distinct proto once instead of once per hypothesis example.
+    # The cached proto is shared and is mutated by its users:
+    # GradientChecker.CheckSimple writes its device option in place, so the
+    # entry keeps whichever device was gradient-checked last. Only pass it to
+    # the hu assert helpers, which set the device option before every run;
+    # never run it directly with workspace.RunOperatorOnce.
+    key = (op_type, tuple(inputs), tuple(outputs),
+           tuple(sorted(kwargs.items())))
+    op = _CACHED_OPS.get(key)
+    if op is None:
+        op = core.CreateOperator(op_type, inputs, outputs, **kwargs)
+        _CACHED_OPS[key] = op
+    return op
+
+
+def _memoize(f):
+    # Inputs are drawn from a fixed seed, so examples that share a shape can
+    # reuse the generated values. The cached arrays are frozen and callers get
+    # copies, since the gradient checker perturbs its inputs in place and the
+    # float32 round trip does not restore them exactly.
+    cache = {}
+
+    def wrapper(*args):
+        if args not in cache:
+            arrays = f(*args)
+            for a in arrays:
+                a.setflags(write=False)
+            cache[args] = arrays
+        return tuple(a.copy() for a in cache[args])
+    return wrapper
+
+
+@_memoize
+def _softmax_inputs(n, D, seed=2603):
+    # n = number of examples, D = |labels|
+    # Initialize X and add 1e-2 for numerical stability
+    rng = np.random.RandomState(seed)
+    X = rng.rand(n, D).astype(np.float32)
+    X += 1e-2
+
+    # Initialize label
+    label = rng.randint(0, D, size=n).astype(np.int32)
+    return X, label
+
+
+@_memoize
+def _spatial_softmax_inputs(n, D, H, W, seed=2603):
+    rng = np.random.RandomState(seed)
+    X = rng.rand(n, D, H, W).astype(np.float32)
+    X += 1e-2
+    weights = rng.rand(n, H, W).astype(np.float32)
+
+    # Initialize label. Some of the labels are (-1), i.e "DONT CARE"
+    label = rng.randint(-1, D, size=(n, H, W)).astype(np.int32)
+    return X, label, weights
+
+
+def _softmax(X, axis=1):
+    # We need to subtract the max to avoid numerical issues. The
+    # exponentials are computed once and reused for the normalizer.
+    exps = np.exp(X - X.max(axis=axis, keepdims=True))
+    return exps / exps.sum(axis=axis, keepdims=True)
+
+
+def _softmax_and_log_softmax(X, axis=1):
+    # log(softmax(X)) = (X - max) - log(sum(exp(X - max))), which avoids
+    # taking the log of a (possibly underflowed) probability.
+    shift = X - X.max(axis=axis, keepdims=True)
+    exps = np.exp(shift)
+    norm = exps.sum(axis=axis, keepdims=True)
+    return exps / norm, shift - np.log(norm)
+
+
 class TestSoftmaxOps(hu.HypothesisTestCase):
 
     @given(n=st.sampled_from([2, 4, 71, 103]),
@@ -18,26 +96,15 @@ class TestSoftmaxOps(hu.HypothesisTestCase):
            engine=st.sampled_from([None, 'CUDNN']),
            **hu.gcs)
     def test_softmax(self, n, D, engine, gc, dc):
-        # n = number of examples, D = |labels|
-        # Initialize X and add 1e-2 for numerical stability
-        X = np.random.rand(n, D).astype(np.float32)
-        X = X + 1e-2
+        X, _ = _softmax_inputs(n, D)
 
         # Reference implementation of cross entropy with soft labels
         def label_softmax(X):
-            probs = np.zeros((n, D))
-            rowmax = np.zeros(n)
-            for i in range(n):
-                rowmax[i] = max(X[i, ])
-                # We need to subtract the max to avoid numerical issues
-                probs[i] = X[i] - rowmax[i]
-                exps = np.exp(probs[i, ])
-                norm = sum(exps)
-                probs[i, ] = exps / norm
+            probs = _softmax(X, axis=1)
 
             return [probs]
 
-        op = core.CreateOperator(
+        op = _cached_op(
             "Softmax",
             ["X"],
             ["probs"],
@@ -60,7 +127,7 @@ class TestSoftmaxOps(hu.HypothesisTestCase):
         # Initialize X and add 1e-2 for numerical stability
         Y = np.random.rand(n, D).astype(np.float32)
         dY = np.random.rand(n, D).astype(np.float32)
-        Y = Y + 1e-2
+        Y += 1e-2
 
         # Reference implementation of cross entropy with soft labels
         def label_softmax_grad(X, dY):
@@ -90,33 +157,17 @@ class TestSoftmaxOps(hu.HypothesisTestCase):
     def test_softmax_axis(self, axis, engine, gc, dc):
         np.random.seed(1)
         X = np.random.randn(1, 2, 3, 2, 1).astype(np.float32)
-        X = X + 1e-2
-
-        def prod(xs):
-            p = 1
-            for x in xs:
-                p *= x
-            return p
+        X += 1e-2
 
-        N = prod(list(X.shape)[:axis])
-        D = prod(list(X.shape)[axis:])
+        N = int(np.prod(X.shape[:axis]))
+        D = int(np.prod(X.shape[axis:]))
 
         # Reference implementation of cross entropy with soft labels
         def label_softmax(X):
             X_ = X.reshape(N, D)
-            probs = np.zeros((N, D))
-            rowmax = np.zeros(N)
-            for i in range(N):
-                rowmax[i] = max(X_[i, ])
-                # We need to subtract the max to avoid numerical issues
-                probs[i] = X_[i] - rowmax[i]
-                exps = np.exp(probs[i, ])
-                norm = sum(exps)
-                probs[i, ] = exps / norm
+            return [_softmax(X_, axis=1).reshape(X.shape)]
 
-            return [probs.reshape(*X.shape)]
-
-        op = core.CreateOperator(
+        op = _cached_op(
             "Softmax",
             ["X"],
             ["probs"],
@@ -137,33 +188,17 @@ class TestSoftmaxOps(hu.HypothesisTestCase):
     @given(n=st.integers(2, 10), D=st.integers(4, 16),
            only_loss=st.booleans(), **hu.gcs)
     def test_softmax_with_loss(self, n, D, gc, only_loss, dc):
-        # n = number of examples, D = |labels|
-        # Initialize X and add 1e-2 for numerical stability
-        np.random.seed(2603)
-        X = np.random.rand(n, D).astype(np.float32)
-        X = X + 1e-2
-
-        # Initialize label
-        label = (np.random.rand(n) * D).astype(np.int32)
+        X, label = _softmax_inputs(n, D)
 
         # Reference implementation of cross entropy with soft labels
         def label_softmax_crossent(X, label):
-            probs = np.zeros((n, D))
-            rowmax = np.zeros(n)
-            for i in range(n):
-                rowmax[i] = max(X[i, ])
-                # We need to subtract the max to avoid numerical issues
-                probs[i] = X[i] - rowmax[i]
-                exps = np.exp(probs[i, ])
-                norm = sum(exps)
-                probs[i, ] = exps / norm
+            probs, logprobs = _softmax_and_log_softmax(X, axis=1)
 
-            label_xent = [-np.log(max(probs[i][label[i]], 1e-20))
-                          for i in range(n)]
-            avgloss = np.sum(label_xent) / float(n)
+            label_xent = -logprobs[np.arange(n), label]
+            avgloss = label_xent.mean()
             return (probs, avgloss)
 
-        op = core.CreateOperator(
+        op = _cached_op(
             "SoftmaxWithLoss",
             ["X", "label"],
             ["probs", "avgloss"],
@@ -193,37 +228,32 @@ class TestSoftmaxOps(hu.HypothesisTestCase):
     ):
         np.random.seed(2603)
         X = np.random.rand(n, n, D).astype(np.float32)
-        X = X + 1e-2
+        X += 1e-2
 
         if label_prob:
             label = np.random.rand(n, n, D).astype(np.float32)
             label /= label.sum(axis=2, keepdims=True)
         else:
-            label = (np.random.rand(n, n) * D).astype(np.int32)
+            label = np.random.randint(0, D, size=(n, n)).astype(np.int32)
 
         # Reference implementation of cross entropy with soft labels
         def label_softmax_crossent(X, label):
-            probs = np.zeros((n, n, D))
-            rowmax = np.zeros((n, n))
+            probs = np.zeros((n, n, D), dtype=np.float32)
+            rowmax = np.zeros((n, n), dtype=np.float32)
             for i in range(n):
                 for j in range(n):
-                    rowmax[i, j] = max(X[i, j, ])
+                    rowmax[i, j] = X[i, j].max()
                     # We need to subtract the max to avoid numerical issues
                     probs[i, j] = X[i, j] - rowmax[i, j]
                     exps = np.exp(probs[i, j, ])
-                    norm = sum(exps)
+                    norm = exps.sum()
                     probs[i, j, ] = exps / norm
-            label_xent = 0
-            for i in range(n):
-                for j in range(n):
-                    if label_prob:
-                        for k in range(D):
-                            label_xent += (
-                                -np.log(max(probs[i, j, k], 1e-20)) *
-                                label[i, j, k]
-                            )
-                    else:
-                        label_xent += -np.log(max(probs[i, j, label[i, j]], 1e-20))
+            if label_prob:
+                label_xent = (-np.log(np.maximum(probs, 1e-20)) * label).sum()
+            else:
+                i, j = np.ogrid[:n, :n]
+                label_xent = -np.log(
+                    np.maximum(probs[i, j, label], 1e-20)).sum()
 
             avgloss = label_xent / float(n * n)
             return (probs, avgloss)
@@ -256,25 +286,25 @@ class TestSoftmaxOps(hu.HypothesisTestCase):
                 # n = number of examples, D = |labels|
                 # Initialize X and add 1e-2 for numerical stability
                 X = np.random.rand(n, D).astype(np.float32)
-                X = X + 1e-2
+                X += 1e-2
 
                 # Initialize label
-                label = (np.random.rand(n) * D).astype(np.int32)
+                label = np.random.randint(0, D, size=n).astype(np.int32)
 
                 # Reference implementation of cross entropy with soft labels
                 def label_softmax_crossent(X, label):
-                    probs = np.zeros((n, D))
-                    rowmax = np.zeros(n)
+                    probs = np.zeros((n, D), dtype=np.float32)
+                    rowmax = np.zeros(n, dtype=np.float32)
                     for i in range(n):
-                        rowmax[i] = max(X[i, ])
+                        rowmax[i] = X[i].max()
                         # We need to subtract the max to avoid numerical issues
                         probs[i] = X[i] - rowmax[i]
                         exps = np.exp(probs[i, ])
-                        norm = sum(exps)
+                        norm = exps.sum()
                         probs[i, ] = exps / norm
 
-                    label_xent = [-np.log(max(probs[i][label[i]], 1e-20))
-                                  for i in range(n)]
+                    p = probs[np.arange(n), label]
+                    label_xent = -np.log(np.maximum(p, 1e-20))
                     avgloss = np.sum(label_xent) / float(n)
                     return (probs, avgloss)
 
@@ -297,7 +327,7 @@ class TestSoftmaxOps(hu.HypothesisTestCase):
         # Initialize X and add 1e-2 for numerical stability
         np.random.seed(2603)
         X = np.random.rand(n, D).astype(np.float32)
-        X = X + 1e-2
+        X += 1e-2
 
         # Initialize label
         label = np.random.rand(D, n).astype(np.float32)
@@ -308,21 +338,17 @@ class TestSoftmaxOps(hu.HypothesisTestCase):
 
         # Reference implementation of cross entropy with soft labels
         def label_softmax_crossent(X, label):
-            probs = np.zeros((n, D))
-            rowmax = np.zeros(n)
+            probs = np.zeros((n, D), dtype=np.float32)
+            rowmax = np.zeros(n, dtype=np.float32)
             for i in range(n):
-                rowmax[i] = max(X[i, ])
+                rowmax[i] = X[i].max()
                 # We need to subtract the max to avoid numerical issues
                 probs[i] = X[i] - rowmax[i]
                 exps = np.exp(probs[i, ])
-                norm = sum(exps)
+                norm = exps.sum()
                 probs[i, ] = exps / norm
 
-            label_xent = np.zeros(X.shape)
-            for i in range(n):
-                for j in range(D):
-                    label_xent[i][j] = -np.log(
-                        max(probs[i, j], 1e-20)) * label[i, j]
+            label_xent = -np.log(np.maximum(probs, 1e-20)) * label
             avgloss = np.sum(label_xent) / float(n)
             return (probs, avgloss)
 
@@ -353,29 +379,29 @@ class TestSoftmaxOps(hu.HypothesisTestCase):
         # Initialize X and add 1e-2 for numerical stability
         np.random.seed(2603)
         X = np.random.rand(n, D).astype(np.float32)
-        X = X + 1e-2
+        X += 1e-2
 
         # Initialize label
-        label = (np.random.rand(n) * D).astype(np.int32)
+        label = np.random.randint(0, D, size=n).astype(np.int32)
 
         # Init weights (weight by sample)
         weights = np.random.rand(n).astype(np.float32)
 
         # Reference implementation of cross entropy with soft labels
         def label_softmax_crossent_weighted(X, label, weights):
-            probs = np.zeros((n, D))
-            rowmax = np.zeros(n)
+            probs = np.zeros((n, D), dtype=np.float32)
+            rowmax = np.zeros(n, dtype=np.float32)
             for i in range(n):
-                rowmax[i] = max(X[i, ])
+                rowmax[i] = X[i].max()
                 # We need to subtract the max to avoid numerical issues
                 probs[i] = X[i] - rowmax[i]
                 exps = np.exp(probs[i, ])
-                norm = sum(exps)
+                norm = exps.sum()
                 probs[i, ] = exps / norm
 
-            label_xent = [-weights[i] * np.log(max(probs[i][label[i]], 1e-20))
-                          for i in range(n)]
-            avgloss = np.sum(label_xent) / sum(weights)
+            p = probs[np.arange(n), label]
+            label_xent = -weights * np.log(np.maximum(p, 1e-20))
+            avgloss = np.sum(label_xent) / weights.sum()
             return (probs, avgloss)
 
         op = core.CreateOperator(
@@ -400,7 +426,7 @@ class TestSoftmaxOps(hu.HypothesisTestCase):
         # n = number of examples, D = |labels|
         # Initialize X and add 1e-2 for numerical stability
         X = np.random.rand(n, D).astype(np.float32)
-        X = X + 1e-2
+        X += 1e-2
 
         # Initialize label
         label = np.random.rand(D, n).astype(np.float32)
@@ -414,22 +440,19 @@ class TestSoftmaxOps(hu.HypothesisTestCase):
 
         # Reference implementation of cross entropy with soft labels
         def label_softmax_crossent_weighted(X, label, weights):
-            probs = np.zeros((n, D))
-            rowmax = np.zeros(n)
+            probs = np.zeros((n, D), dtype=np.float32)
+            rowmax = np.zeros(n, dtype=np.float32)
             for i in range(n):
-                rowmax[i] = max(X[i, ])
+                rowmax[i] = X[i].max()
                 # We need to subtract the max to avoid numerical issues
                 probs[i] = X[i] - rowmax[i]
                 exps = np.exp(probs[i, ])
-                norm = sum(exps)
+                norm = exps.sum()
                 probs[i, ] = exps / norm
 
-            label_xent = np.zeros(X.shape)
-            for i in range(n):
-                for j in range(D):
-                    label_xent[i][j] = -np.log(
-                        max(probs[i, j], 1e-20)) * label[i, j] * weights[i]
-            avgloss = np.sum(label_xent) / sum(weights)
+            label_xent = (-np.log(np.maximum(probs, 1e-20)) * label *
+                          weights[:, np.newaxis])
+            avgloss = np.sum(label_xent) / weights.sum()
             return (probs, avgloss)
 
         op = core.CreateOperator(
@@ -449,58 +472,37 @@ class TestSoftmaxOps(hu.HypothesisTestCase):
         self.assertGradientChecks(
             gc, op, [X, label, weights], 0, [1], stepsize=1e-4, threshold=1e-2)
 
-    @given(n=st.integers(2, 5), D=st.integers(2, 4),
+    # The reference and gradient check are expensive and the search space is
+    # small, so run a fifth of the loaded profile's examples.
+    @settings(max_examples=max(2, settings.default.max_examples // 5))
+    @given(n=st.integers(2, 4), D=st.integers(2, 3),
            weighted=st.booleans(), **hu.gcs)
     def test_spatial_softmax_with_loss(self, n, D, weighted, gc, dc):
         # n = number of examples, D = |labels|
-        # Initialize X and add 1e-2 for numerical stability
         W = 18
         H = 12
-        np.random.seed(2603)
-        X = np.random.rand(n, D, H, W).astype(np.float32)
-        X = X + 1e-2
+        X, label, all_weights = _spatial_softmax_inputs(n, D, H, W)
 
         weighted = True
-        weights = None
-        if weighted:
-            weights = np.random.rand(n, H, W).astype(np.float32)
-
-        # Initialize label. Some of the labels are (-1), i.e "DONT CARE"
-        label = (np.random.rand(n, H, W) * (D + 1)).astype(np.int32) - 1
+        weights = all_weights if weighted else None
 
         def label_softmax_crossent_spatial(X, label, weights=None):
-            probs = np.zeros((n, D, H, W))
-            rowmax = np.zeros((n, H, W))
-            label_xent = np.zeros((n, H, W))
-            for i in range(n):
-                for x in range(W):
-                    for y in range(H):
-                        rowmax[i, y, x] = max(X[i, :, y, x])
-                        # We need to subtract the max to avoid numerical issues
-                        probs[i, :, y, x] = X[i, :, y, x] - rowmax[i, y, x]
-                        exps = np.exp(probs[i, :, y, x])
-                        probs[i, :, y, x] = exps / sum(exps)
+            probs, logprobs = _softmax_and_log_softmax(X, axis=1)
 
-                        label_xent[:, y, x] = \
-                            [-np.log(max(probs[j, label[i, y, x], y, x], 1e-20))
-                             for j in range(n)]
+            # Gather the log-probability of the true label at every pixel;
+            # "DONT CARE" (-1) pixels are masked out of the loss below.
+            label_safe = np.where(label == -1, 0, label)
+            i, y, x = np.ogrid[:n, :H, :W]
+            logp = logprobs[i, label_safe, y, x]
+            mask = (label != -1).astype(np.float32)
+            w = mask if weights is None else weights * mask
 
-            total_xent = 0.0
-            total_weight = 0.0
-            for y in range(H):
-                for x in range(W):
-                    for i in range(n):
-                        l = label[i, y, x]
-                        if (l != (-1)):
-                            w = 1.0 if weights is None else weights[i, y, x]
-                            total_xent += \
-                                -np.log(max(probs[i, l, y, x], 1e-20)) * w
-                            total_weight += w
-            print("Total weight {}".format(total_weight))
+            total_xent = -(logp * w).sum()
+            total_weight = w.sum()
 
             return (probs, total_xent / total_weight)
 
-        op = core.CreateOperator(
+        op = _cached_op(
             "SpatialSoftmaxWithLoss",
             ["X", "label"] + ([] if weights is None else ["weights"]),
             ["probs", "avgloss"],
@@ -514,8 +516,16 @@ class TestSoftmaxOps(hu.HypothesisTestCase):
             reference=label_softmax_crossent_spatial,
         )
 
+        # The finite-difference check costs two op runs per element of X,
+        # so check the gradient on a small spatial extent only. The helper
+        # returns fresh copies, so the in-place perturbations made by the
+        # gradient checker do not carry over to later examples.
+        X_small, label_small, weights_small = _spatial_softmax_inputs(
+            n, D, 4, 4)
+        grad_inputs = [X_small, label_small] + (
+            [] if weights is None else [weights_small])
         self.assertGradientChecks(
-            gc, op, inputs, 0, [1], stepsize=1e-4, threshold=1e-2)
+            gc, op, grad_inputs, 0, [1], stepsize=1e-4, threshold=1e-2)
 
     @given(n=st.integers(4, 5), D=st.integers(3, 4),
            weighted=st.booleans(), **hu.gcs)
@@ -526,7 +536,7 @@ class TestSoftmaxOps(hu.HypothesisTestCase):
         H = 12
         np.random.seed(2603)
         X = np.random.rand(n, D, H, W).astype(np.float32)
-        X = X + 1e-2
+        X += 1e-2
 
         weighted = True
         weights = None
@@ -534,25 +544,19 @@ class TestSoftmaxOps(hu.HypothesisTestCase):
             weights = np.random.rand(n, H, W).astype(np.float32)
 
         # Initialize label. All labels as "DONT CARE"
-        label = np.zeros((n, H, W)).astype(np.int32) - 1
-        print(label)
+        label = np.full((n, H, W), -1, dtype=np.int32)
 
         def label_softmax_crossent_spatial(X, label, weights=None):
-            probs = np.zeros((n, D, H, W))
-            rowmax = np.zeros((n, H, W))
-            label_xent = np.zeros((n, H, W))
+            probs = np.zeros((n, D, H, W), dtype=np.float32)
+            rowmax = np.zeros((n, H, W), dtype=np.float32)
             for i in range(n):
                 for x in range(W):
                     for y in range(H):
-                        rowmax[i, y, x] = max(X[i, :, y, x])
+                        rowmax[i, y, x] = X[i, :, y, x].max()
                         # We need to subtract the max to avoid numerical issues
                         probs[i, :, y, x] = X[i, :, y, x] - rowmax[i, y, x]
                         exps = np.exp(probs[i, :, y, x])
-                        probs[i, :, y, x] = exps / sum(exps)
-
-                        label_xent[:, y, x] = \
-                            [-np.log(max(probs[j, label[i, y, x], y, x], 1e-20))
-                            for j in range(n)]
+                        probs[i, :, y, x] = exps / exps.sum()
 
             return (probs, 0.0)
 
@@ -577,22 +581,22 @@ class TestSoftmaxOps(hu.HypothesisTestCase):
         # Initialize X and add 1e-2 for numerical stability
         np.random.seed(2603)
         X = np.random.rand(n, D).astype(np.float32)
-        X = X + 1e-2
+        X += 1e-2
 
-        weights = np.zeros(n).astype(np.float32)
+        weights = np.zeros(n, dtype=np.float32)
 
         # Initialize label
-        label = (np.random.rand(n) * D).astype(np.int32)
+        label = np.random.randint(0, D, size=n).astype(np.int32)
 
         def label_softmax_crossent(X, label, weights=None):
-            probs = np.zeros((n, D))
-            rowmax = np.zeros((n))
+            probs = np.zeros((n, D), dtype=np.float32)
+            rowmax = np.zeros(n, dtype=np.float32)
             for i in range(n):
-                rowmax[i] = max(X[i, ])
+                rowmax[i] = X[i].max()
                 # We need to subtract the max to avoid numerical issues
                 probs[i] = X[i] - rowmax[i]
                 exps = np.exp(probs[i, ])
-                norm = sum(exps)
+                norm = exps.sum()
                 probs[i, ] = exps / norm
             return (probs, 0.0)
 
@@ -617,49 +621,50 @@ class TestSoftmaxOps(hu.HypothesisTestCase):
         with larger examples. This is mainly to test the more complex
         GPU implementation is correct.
         '''
-        from caffe2.proto import caffe2_pb2
-
-        for _j in range(3):
-            gpuop = core.CreateOperator(
-                "SpatialSoftmaxWithLoss",
-                ["X_gpu", "label_gpu"],
-                ["probs_gpu", "avgloss_gpu"],
-                device_option=core.DeviceOption(caffe2_pb2.CUDA, 0)
-            )
-
-            cpuop = core.CreateOperator(
-                "SpatialSoftmaxWithLoss",
-                ["X_cpu", "label_cpu"],
-                ["probs_cpu", "avgloss_cpu"],
-                device_option=core.DeviceOption(caffe2_pb2.CPU)
-            )
+        gpuop = core.CreateOperator(
+            "SpatialSoftmaxWithLoss",
+            ["X_gpu", "label_gpu"],
+            ["probs_gpu", "avgloss_gpu"],
+            device_option=hu.gpu_do
+        )
 
+        cpuop = core.CreateOperator(
+            "SpatialSoftmaxWithLoss",
+            ["X_cpu", "label_cpu"],
+            ["probs_cpu", "avgloss_cpu"],
+            device_option=hu.cpu_do
+        )
+
+        # A fixed set of three seeded trials, so the number and size of the
+        # runs do not depend on the hypothesis profile.
+        for seed in range(3):
+            rng = np.random.RandomState(seed)
             n = 8
             D = 4
-            W = 64 + int(np.random.rand(1) * 1024)
-            H = 64 + int(np.random.rand(1) * 1024)
-
-            print("W: {} H: {}".format(W, H))
+            W = int(rng.randint(64, 320))
+            H = int(rng.randint(64, 320))
 
-            X = np.random.rand(n, D, H, W).astype(np.float32)
-            X = X + 1e-2
+            X = rng.rand(n, D, H, W).astype(np.float32)
+            X += 1e-2
 
             # Initialize label. Some of the labels are (-1), i.e "DONT CARE"
-            label = (np.random.rand(n, H, W) * (D + 1)).astype(np.int32) - 1
-
-            gpu0 = core.DeviceOption(caffe2_pb2.CUDA, 0)
-            workspace.FeedBlob("X_cpu", X)
-            workspace.FeedBlob("label_cpu", label)
-            workspace.FeedBlob("X_gpu", X, device_option=gpu0)
-            workspace.FeedBlob("label_gpu", label, device_option=gpu0)
-
-            workspace.RunOperatorOnce(gpuop)
-            workspace.RunOperatorOnce(cpuop)
-
-            probs_gpu = workspace.FetchBlob("probs_gpu")
-            probs_cpu = workspace.FetchBlob("probs_cpu")
-            loss_gpu = workspace.FetchBlob("avgloss_gpu")
-            loss_cpu = workspace.FetchBlob("avgloss_cpu")
+            label = rng.randint(-1, D, size=(n, H, W)).astype(np.int32)
+
+            # Run in a scratch workspace so the blobs neither leak into nor
+            # collide with whatever else is in the current workspace.
+            with hu.temp_workspace():
+                workspace.FeedBlob("X_cpu", X)
+                workspace.FeedBlob("label_cpu", label)
+                workspace.FeedBlob("X_gpu", X, device_option=hu.gpu_do)
+                workspace.FeedBlob("label_gpu", label, device_option=hu.gpu_do)
+
+                workspace.RunOperatorOnce(gpuop)
+                workspace.RunOperatorOnce(cpuop)
+
+                probs_gpu = workspace.FetchBlob("probs_gpu")
+                probs_cpu = workspace.FetchBlob("probs_cpu")
+                loss_gpu = workspace.FetchBlob("avgloss_gpu")
+                loss_cpu = workspace.FetchBlob("avgloss_cpu")
 
             np.testing.assert_allclose(probs_gpu, probs_cpu, rtol=1e-4)
             np.testing.assert_allclose(loss_gpu, loss_cpu, rtol=1e-1)